@@ -10,6 +10,7 @@ Populate Google Workspace / Cloud Identity users with posixAccounts if missing.
 
 Install:
   pip install google-auth google-auth-httplib2 google-api-python-client
+  pip install orjson   # optional: faster decoding of users.list pages
 
 Example (dry run):
   ./autogen-posix.py \
@@ -25,73 +26,42 @@ Apply changes:
 """
 
 import argparse
-import random
-import re
+import functools
+import os
 import sys
-import time
-from typing import Dict, List, Set, Tuple, Optional
 
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
 
-SCOPE_USER_RW = "https://www.googleapis.com/auth/admin.directory.user"
+# Shared helpers live next to the Cloud Function entrypoint (src/) so both deploy paths use one copy.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+
+from _core import (  # noqa: E402
+    SCOPE_USER_RW,
+    TokenBucket,
+    allocate_ids,
+    build_directory_service,
+    is_retryable,
+    iter_users,
+    patch_users_batched,
+    scan_users,
+    uid_tracker,
+    users_list_kwargs,
+)
 
 
 # ---------- Auth / API helpers ----------
 
-def get_directory_service(sa_key_path: str, subject: str):
-    creds = service_account.Credentials.from_service_account_file(
+@functools.lru_cache(maxsize=4)
+def _load_creds(sa_key_path: str):
+    # Parsing the RSA key is the expensive part; with_subject() on the result is cheap.
+    return service_account.Credentials.from_service_account_file(
         sa_key_path, scopes=[SCOPE_USER_RW]
-    ).with_subject(subject)
-    return build("admin", "directory_v1", credentials=creds, cache_discovery=False)
-
-
-def backoff_sleep(attempt: int):
-    # Exponential backoff with jitter, capped.
-    delay = min(32, 2 ** attempt) + random.random()
-    time.sleep(delay)
-
-
-# ---------- Username sanitization ----------
-
-def sanitize_username(raw: str, strip_suffix: Optional[str]) -> str:
-    """
-    Lowercase, keep [a-z0-9._-], optionally strip a domain-derived suffix like '_mydomain_com'.
-    """
-    name = "".join(c for c in raw.lower() if c.isalnum() or c in ("-", "_", "."))
-    if strip_suffix:
-        if name.endswith(strip_suffix.lower()):
-            name = name[: -len(strip_suffix)]
-    else:
-        # Generic pattern: remove "_example_com" style suffixes (safe default)
-        name = re.sub(r"_[a-z0-9]+_com$", "", name)
-    # Trim to 32 chars (typical Linux username limit)
-    return name[:32] or "user"
-
-
-def unique_username(base: str, taken: Set[str]) -> str:
-    if base not in taken:
-        taken.add(base)
-        return base
-    # Append -N until free
-    i = 1
-    while True:
-        cand = f"{base}-{i}"
-        if cand not in taken:
-            taken.add(cand)
-            return cand
-        i += 1
-
+    )
 
-# ---------- ID allocation ----------
 
-def next_free(start: int, used: Set[int]) -> int:
-    n = start
-    while n in used:
-        n += 1
-    used.add(n)
-    return n
+def get_directory_service(sa_key_path: str, subject: str):
+    creds = _load_creds(sa_key_path).with_subject(subject)
+    return build_directory_service(creds)
 
 
 # ---------- Main ----------
@@ -105,6 +75,8 @@ def main():
     grp.add_argument("--domain", help="Restrict to a specific domain (e.g., example.com).")
 
     ap.add_argument("--start-uid", type=int, default=20000, help="Starting UID to allocate from.")
+    ap.add_argument("--max-uid", type=int, default=None,
+                    help="Highest UID to allocate; bounds the range so used UIDs are tracked in a compact bitmap.")
     ap.add_argument("--start-gid", type=int, default=20000, help="Starting GID to allocate from (ignored if --gid-equals-uid).")
     ap.add_argument("--gid-equals-uid", action="store_true", default=True, help="Assign GID = UID (user-private groups).")
     ap.add_argument("--no-gid-equals-uid", dest="gid_equals_uid", action="store_false")
@@ -121,127 +93,33 @@ def main():
         args.commit = False
 
     svc = get_directory_service(args.sa_key, args.impersonate)
+    bucket = TokenBucket(args.rps, burst=args.rps)
+    vlog = (lambda msg: print(msg, file=sys.stderr)) if args.verbose else None
 
     # Prepare request to list users with minimal necessary fields
-    list_kwargs = dict(
-        projection="full",
-        maxResults=200,
-        orderBy="email",
-        fields="users(id,primaryEmail,name/fullName,suspended,deleted,posixAccounts,etag),nextPageToken",
-    )
-    if args.domain:
-        list_kwargs["domain"] = args.domain
-    else:
-        list_kwargs["customer"] = args.customer
+    list_kwargs = users_list_kwargs(args.customer, args.domain)
 
+    # First pass: scan all users (next page is fetched while this one is classified).
     # Collect existing UIDs/GIDs to avoid collisions; also collect users missing posixAccounts
-    used_uids: Set[int] = set()
-    used_gids: Set[int] = set()
-    missing: List[Dict] = []
-    taken_usernames: Set[str] = set()
-
-    # First pass: scan all users
-    req = svc.users().list(**list_kwargs)
-    while req is not None:
-        # Pacing
-        if args.rps > 0:
-            time.sleep(1.0 / args.rps)
-
-        # Execute with backoff
-        last_exc = None
-        for attempt in range(args.max_retries + 1):
-            try:
-                resp = req.execute()
-                break
-            except HttpError as e:
-                last_exc = e
-                # Retry on 429/5xx, rate/user limits
-                status = getattr(e, "resp", None).status if getattr(e, "resp", None) else None
-                msg = str(e)
-                if status in (429, 500, 502, 503, 504) or "rateLimitExceeded" in msg or "userRateLimitExceeded" in msg:
-                    if args.verbose:
-                        print(f"[WARN] list users backoff attempt {attempt+1}: {status}", file=sys.stderr)
-                    backoff_sleep(attempt)
-                    continue
-                raise
-        else:
-            raise last_exc  # exhausted retries
-
-        for u in resp.get("users", []):
-            if u.get("deleted") or u.get("suspended"):
-                continue
-
-            posix_list = u.get("posixAccounts", []) or []
-            if posix_list:
-                # harvest used IDs and taken usernames
-                for pa in posix_list:
-                    try:
-                        uid = int(pa.get("uid")) if pa.get("uid") is not None else None
-                        gid = int(pa.get("gid")) if pa.get("gid") is not None else None
-                        if uid is not None:
-                            used_uids.add(uid)
-                        if gid is not None:
-                            used_gids.add(gid)
-                        uname = pa.get("username")
-                        if uname:
-                            taken_usernames.add(uname.lower())
-                    except (TypeError, ValueError):
-                        pass
-                continue
-
-            # No posixAccounts → candidate to populate
-            primary_email = u.get("primaryEmail", "")
-            local = primary_email.split("@")[0] if "@" in primary_email else primary_email
-            base_username = sanitize_username(local, args.strip_suffix)
-            # don't finalize yet; uniqueness enforced after full scan
-            missing.append({
-                "id": u["id"],
-                "primaryEmail": primary_email,
-                "fullName": (u.get("name") or {}).get("fullName") or base_username,
-                "baseUsername": base_username,
-            })
-
-        req = svc.users().list_next(previous_request=req, previous_response=resp)
+    used_uids, used_gids, all_taken, missing = scan_users(
+        iter_users(svc, list_kwargs, bucket, args.max_retries, vlog), args.strip_suffix, args.gid_equals_uid,
+        used_uids=uid_tracker(args.start_uid, args.max_uid),
+    )
 
     if args.verbose:
         print(f"[INFO] scanned users; missing posixAccounts for {len(missing)} users", file=sys.stderr)
 
-    # Allocate usernames/UIDs/GIDs without collisions
-    planned: List[Tuple[str, Dict]] = []  # (user_id, posix body)
-    next_uid = args.start_uid
-    next_gid = args.start_gid
-    # Ensure username uniqueness considers existing ones and those we will add in this run
-    local_taken = set(taken_usernames)
-
-    for m in missing:
-        uname = unique_username(m["baseUsername"], local_taken)
-        # Allocate UID
-        uid = next_free(max(next_uid, args.start_uid), used_uids)
-        next_uid = uid + 1
-        # Allocate GID
-        if args.gid_equals_uid:
-            gid = uid
-            used_gids.add(gid)
-            if next_gid <= gid:
-                next_gid = gid + 1
-        else:
-            gid = next_free(max(next_gid, args.start_gid), used_gids)
-            next_gid = gid + 1
-
-        home = args.home_template.format(username=uname)
-        shell = args.default_shell
-        gecos = m["fullName"]
-
-        posix_obj = {
-            "primary": True,
-            "username": uname,
-            "uid": uid,
-            "gid": gid,
-            "homeDirectory": home,
-            "shell": shell,
-            "gecos": gecos,
-        }
-        planned.append((m["id"], posix_obj))
+    # Allocate usernames/UIDs/GIDs without collisions.
+    # Ensure username uniqueness considers existing ones and those we will add in this run;
+    # all_taken is extended in place (nothing reads the harvested set afterwards).
+    planned = allocate_ids(
+        missing, all_taken, used_uids, used_gids,
+        start_uid=args.start_uid,
+        start_gid=args.start_gid,
+        gid_equals_uid=args.gid_equals_uid,
+        home_template=args.home_template,
+        default_shell=args.default_shell,
+    )
 
     # Report plan
     if not planned:
@@ -256,36 +134,14 @@ def main():
         print("\nDRY RUN (no changes made). Re-run with --commit to apply.")
         return
 
-    # Apply via users.patch
-    updated = 0
-    for user_id, posix in planned:
-        # Pacing
-        if args.rps > 0:
-            time.sleep(1.0 / args.rps)
-
-        body = {"posixAccounts": [posix]}
-        last_exc = None
-        for attempt in range(args.max_retries + 1):
-            try:
-                _ = svc.users().patch(userKey=user_id, body=body).execute()
-                updated += 1
-                if args.verbose:
-                    print(f"[OK] Updated {user_id} → {posix['username']} ({posix['uid']}:{posix['gid']})", file=sys.stderr)
-                break
-            except HttpError as e:
-                last_exc = e
-                status = getattr(e, "resp", None).status if getattr(e, "resp", None) else None
-                msg = str(e)
-                if status in (429, 500, 502, 503, 504) or "rateLimitExceeded" in msg or "userRateLimitExceeded" in msg:
-                    if args.verbose:
-                        print(f"[WARN] patch backoff attempt {attempt+1} for {user_id}: {status}", file=sys.stderr)
-                    backoff_sleep(attempt)
-                    continue
-                # conflict / invalid → show and continue
-                print(f"[ERROR] Failed to update {user_id}: {e}", file=sys.stderr)
-                break
+    # Apply via batched users.patch
+    updated, failed = patch_users_batched(svc, planned, bucket, args.max_retries, vlog)
+    for user_id, exc in failed.items():
+        if is_retryable(exc):
+            print(f"[ERROR] Retries exhausted for {user_id}: {exc}", file=sys.stderr)
         else:
-            print(f"[ERROR] Retries exhausted for {user_id}: {last_exc}", file=sys.stderr)
+            # conflict / invalid → show and continue
+            print(f"[ERROR] Failed to update {user_id}: {exc}", file=sys.stderr)
 
     print(f"\nDone. Updated {updated}/{len(planned)} users.")
 
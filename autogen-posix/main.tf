@@ -163,6 +163,7 @@ resource "google_cloudfunctions2_function" "fn" {
       DOMAIN              = var.domain
       START_UID           = tostring(var.start_uid)
       START_GID           = tostring(var.start_gid)
+      MAX_UID             = tostring(var.max_uid)
       GID_EQUALS_UID      = var.gid_equals_uid ? "true" : "false"
       DEFAULT_SHELL       = var.default_shell
       HOME_TEMPLATE       = var.home_template
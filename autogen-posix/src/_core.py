@@ -0,0 +1,493 @@
+"""
+Shared helpers for populating Workspace posixAccounts.
+
+Used by both entrypoints:
+  - ../autogen-posix.py  (CLI, service account key file)
+  - main.py              (Cloud Function, key from Secret Manager)
+
+Lives under src/ so it ships in the Cloud Function source archive; the CLI
+adds this directory to sys.path before importing it.
+"""
+
+import datetime as dt
+import email.utils
+import functools
+import random
+import re
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build_from_document
+from googleapiclient.errors import HttpError
+from googleapiclient.model import JsonModel
+
+try:
+    import orjson
+except ImportError:  # optional speedup; stdlib json is used when absent
+    orjson = None
+
+SCOPE_USER_RW = "https://www.googleapis.com/auth/admin.directory.user"
+
+# Directory API batch endpoint accepts at most 50 sub-requests per call.
+PATCH_BATCH_SIZE = 50
+
+# Optional verbose logger: called with a ready-to-print message.
+Log = Optional[Callable[[str], None]]
+
+
+# ---------- Auth / API helpers ----------
+
+@functools.lru_cache(maxsize=1)
+def directory_discovery_doc() -> str:
+    """
+    The admin/directory_v1 discovery document bundled with google-api-python-client
+    (pinned by the client version in requirements.txt), so startup never fetches it
+    over HTTPS. Refresh it by upgrading the client, not at runtime.
+    """
+    doc = discovery_cache.get_static_doc("admin", "directory_v1")
+    if doc is None:
+        raise RuntimeError("google-api-python-client has no bundled admin/directory_v1 discovery document")
+    return doc
+
+
+class OrjsonModel(JsonModel):
+    """JsonModel that decodes response bodies (list pages, batch parts) with orjson."""
+
+    def deserialize(self, content):
+        try:
+            body = orjson.loads(content)
+        except orjson.JSONDecodeError:
+            return content.decode("utf-8") if isinstance(content, bytes) else content
+        if self._data_wrapper and "data" in body:
+            body = body["data"]
+        return body
+
+
+def build_directory_service(delegated):
+    """Directory API client for already-delegated (with_subject) credentials."""
+    model = OrjsonModel() if orjson is not None else None
+    return build_from_document(directory_discovery_doc(), credentials=delegated, model=model)
+
+
+def users_list_kwargs(customer: Optional[str], domain: Optional[str]) -> Dict:
+    # (posixAccounts is a core field, so the "basic" projection still returns it
+    # while skipping custom schemas; 500 is the users.list page-size maximum).
+    # Suspended and deleted users are skipped anyway, so filter them server-side;
+    # scan_users() keeps its own check as a safety net.
+    kwargs = dict(
+        projection="basic",
+        maxResults=500,
+        orderBy="email",
+        query="isSuspended=false",
+        showDeleted="false",
+        fields="users(id,primaryEmail,name/fullName,suspended,deleted,posixAccounts(username,uid,gid)),nextPageToken",
+    )
+    if domain:
+        kwargs["domain"] = domain
+    else:
+        kwargs["customer"] = customer or "my_customer"
+    return kwargs
+
+
+# ---------- Pacing / retries ----------
+
+class TokenBucket:
+    """
+    Token-bucket rate limiter: refills at `rate` tokens/sec up to `burst` tokens and
+    only sleeps when the bucket is empty, so time spent waiting on the network counts
+    toward the request budget. A rate <= 0 disables pacing.
+    """
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.last_refill = time.monotonic()
+                self.tokens = 0.0
+            else:
+                self.tokens -= 1
+
+
+def is_retryable(e: Exception) -> bool:
+    # Retry on 429/5xx, rate/user limits
+    status = getattr(e, "resp", None).status if getattr(e, "resp", None) else None
+    msg = str(e)
+    return status in (429, 500, 502, 503, 504) or "rateLimitExceeded" in msg or "userRateLimitExceeded" in msg
+
+
+def retry_after_seconds(e: Exception) -> Optional[float]:
+    resp = getattr(e, "resp", None)
+    value = resp.get("retry-after") if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=dt.timezone.utc)
+    return max(0.0, (when - dt.datetime.now(dt.timezone.utc)).total_seconds())
+
+
+def sleep_for_retry(e: Exception, attempt: int):
+    """
+    Sleep before retrying a request that failed with `e`. Honors the server's
+    Retry-After header (delta-seconds or HTTP-date) when present; otherwise falls
+    back to exponential backoff with jitter, capped.
+    """
+    delay = retry_after_seconds(e)
+    if delay is None:
+        delay = min(32, 2 ** attempt) + random.random()
+    time.sleep(delay)
+
+
+def execute_with_retry(req, bucket: TokenBucket, max_retries: int, log: Log = None, what: str = "list users"):
+    bucket.acquire()
+    last_exc = None
+    for attempt in range(max_retries + 1):
+        try:
+            return req.execute()
+        except HttpError as e:
+            last_exc = e
+            if is_retryable(e):
+                if log:
+                    log(f"[WARN] {what} backoff attempt {attempt+1}: {e.resp.status if e.resp else None}")
+                sleep_for_retry(e, attempt)
+                continue
+            raise
+    raise last_exc  # exhausted retries
+
+
+# ---------- Listing ----------
+
+def iter_users(svc, list_kwargs: Dict, bucket: TokenBucket, max_retries: int, log: Log = None) -> Iterator[Dict]:
+    """
+    Yield every user from users.list. The request for page N+1 is issued on a worker
+    thread as soon as page N arrives, so its network latency overlaps with the caller
+    processing page N. Only one request is in flight at a time, so the underlying
+    (non thread-safe) httplib2 connection is never shared concurrently.
+    """
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        req = svc.users().list(**list_kwargs)
+        fut = pool.submit(execute_with_retry, req, bucket, max_retries, log)
+        while fut is not None:
+            resp = fut.result()
+            req = svc.users().list_next(previous_request=req, previous_response=resp)
+            fut = pool.submit(execute_with_retry, req, bucket, max_retries, log) if req is not None else None
+            yield from resp.get("users", []) or []
+
+
+def scan_users(
+    users: Iterator[Dict],
+    strip_suffix: Optional[str],
+    gid_equals_uid: bool,
+    used_uids=None,
+) -> Tuple[Set[int], Set[int], Set[str], List[Tuple[str, str, str]]]:
+    """
+    Classify active users. Returns (used_uids, used_gids, taken_usernames, missing)
+    where `missing` holds (user_id, fullName, baseUsername) for users without any
+    posixAccounts entry; usernames are not made unique until planning.
+
+    With gid_equals_uid, GIDs are never allocated independently, so existing GIDs
+    are not harvested and `used_gids` stays empty. Pass an IdBitmap as `used_uids`
+    to record UIDs compactly when the allocation range is bounded.
+    """
+    harvest_gids = not gid_equals_uid
+    if used_uids is None:
+        used_uids = set()
+    used_gids: Set[int] = set()
+    taken_usernames: Set[str] = set()
+    missing: List[Tuple[str, str, str]] = []
+
+    for u in users:
+        if u.get("deleted") or u.get("suspended"):
+            continue
+
+        posix_list = u.get("posixAccounts", []) or []
+        if posix_list:
+            # harvest used IDs and taken usernames
+            for pa in posix_list:
+                try:
+                    uid = int(pa.get("uid")) if pa.get("uid") is not None else None
+                    if uid is not None:
+                        used_uids.add(uid)
+                    if harvest_gids and pa.get("gid") is not None:
+                        used_gids.add(int(pa.get("gid")))
+                    uname = pa.get("username")
+                    if uname:
+                        taken_usernames.add(uname.lower())
+                except (TypeError, ValueError):
+                    pass
+            continue
+
+        # No posixAccounts → candidate to populate
+        primary_email = u.get("primaryEmail", "")
+        local = primary_email.split("@")[0] if "@" in primary_email else primary_email
+        base_username = sanitize_username(local, strip_suffix)
+        # Keep only what planning needs, as a compact tuple, so the page dicts can be freed.
+        missing.append((u["id"], (u.get("name") or {}).get("fullName") or base_username, base_username))
+
+    return used_uids, used_gids, taken_usernames, missing
+
+
+# ---------- Username sanitization ----------
+
+_USERNAME_CHARS = frozenset(string.ascii_lowercase + string.digits + "-_.")
+# str.translate table deleting every ASCII character not allowed in a username
+_USERNAME_DROP_ASCII = str.maketrans("", "", "".join(chr(i) for i in range(128) if chr(i) not in _USERNAME_CHARS))
+_DOMAIN_SUFFIX_RE = re.compile(r"_[a-z0-9]+_com$")
+
+
+def sanitize_username(raw: str, strip_suffix: Optional[str]) -> str:
+    """
+    Lowercase, keep [a-z0-9._-], optionally strip a domain-derived suffix like '_mydomain_com'.
+    """
+    lowered = raw.lower()
+    if lowered.isascii():
+        name = lowered.translate(_USERNAME_DROP_ASCII)
+    else:
+        # Non-ASCII letters/digits are kept, as str.isalnum() allows them
+        name = "".join(c for c in lowered if c.isalnum() or c in ("-", "_", "."))
+    if strip_suffix:
+        s = strip_suffix.lower()
+        if name.endswith(s):
+            name = name[: -len(s)]
+    else:
+        # Generic pattern: remove "_example_com" style suffixes (safe default)
+        name = _DOMAIN_SUFFIX_RE.sub("", name)
+    # Trim to 32 chars (typical Linux username limit)
+    return name[:32] or "user"
+
+
+def unique_username(base: str, taken: Set[str], collision_counts: Optional[Dict[str, int]] = None) -> str:
+    """
+    Return `base`, or `base-N` for the smallest free N, and mark it taken.
+    Pass the same `collision_counts` dict across calls to resume the -N search
+    where the previous collision on `base` left off instead of restarting at 1.
+    """
+    if base not in taken:
+        taken.add(base)
+        return base
+    # Append -N until free
+    i = collision_counts.get(base, 0) + 1 if collision_counts is not None else 1
+    while True:
+        cand = f"{base}-{i}"
+        if cand not in taken:
+            taken.add(cand)
+            if collision_counts is not None:
+                collision_counts[base] = i
+            return cand
+        i += 1
+
+
+# ---------- ID allocation ----------
+
+class IdBitmap:
+    """
+    Set-like record of used IDs in [start, end], one bit per ID in a bytearray
+    (~12 KB per 100k IDs instead of a boxed int + hash slot per member).
+
+    IDs outside the range are ignored by add() and reported absent: allocation
+    never leaves the range, so they cannot collide with anything it hands out.
+    """
+
+    def __init__(self, start: int, end: int):
+        if end < start:
+            raise ValueError(f"empty ID range [{start},{end}]")
+        self.start = start
+        self.end = end
+        self.buf = bytearray((end - start) // 8 + 1)
+
+    def add(self, n: int):
+        if self.start <= n <= self.end:
+            i = n - self.start
+            self.buf[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, n: int) -> bool:
+        if not self.start <= n <= self.end:
+            return False
+        i = n - self.start
+        return bool(self.buf[i >> 3] >> (i & 7) & 1)
+
+    def first_free_from(self, n: int) -> Optional[int]:
+        """Lowest ID >= n in range that is not set, or None if the range is exhausted."""
+        size = self.end - self.start + 1
+        i = max(n, self.start) - self.start
+        while i < size:
+            # Inspect up to 64 bits at once: the lowest zero bit of the word is the answer.
+            byte = i >> 3
+            chunk = self.buf[byte:byte + 8]
+            shift = i & 7
+            nbits = 8 * len(chunk) - shift
+            free = ~(int.from_bytes(chunk, "little") >> shift) & ((1 << nbits) - 1)
+            if free:
+                i += (free & -free).bit_length() - 1
+                return self.start + i if i < size else None
+            i += nbits
+        return None
+
+
+class IdAllocator:
+    """
+    Hands out the lowest free IDs >= start that are not in `used`.
+
+    The cursor only moves forward, so a contiguous block of existing IDs is
+    skipped once rather than rescanned for every allocation; IDs added to `used`
+    behind the cursor's back (e.g. gid = uid) are stepped over when reached.
+    `used` may be a set or an IdBitmap, which finds the next free ID a word at a time.
+    """
+
+    def __init__(self, start: int, used):
+        self.cursor = start
+        self.used = used
+
+    def next(self) -> int:
+        first_free_from = getattr(self.used, "first_free_from", None)
+        if first_free_from is not None:
+            n = first_free_from(self.cursor)
+            if n is None:
+                raise RuntimeError(f"Out of IDs in range [{self.used.start},{self.used.end}]")
+        else:
+            n = self.cursor
+            while n in self.used:
+                n += 1
+        self.used.add(n)
+        self.cursor = n + 1
+        return n
+
+
+def uid_tracker(start_uid: int, max_uid: Optional[int]):
+    """Container for used UIDs: a bitmap over [start_uid, max_uid] when bounded, else a set."""
+    return IdBitmap(start_uid, max_uid) if max_uid else set()
+
+
+def allocate_ids(
+    missing: List[Tuple[str, str, str]],
+    taken: Set[str],
+    used_uids,
+    used_gids: Set[int],
+    *,
+    start_uid: int,
+    start_gid: int,
+    gid_equals_uid: bool,
+    home_template: str,
+    default_shell: str,
+) -> List[Tuple[str, Dict]]:
+    """
+    Plan a posixAccounts body for each (user_id, fullName, baseUsername) in `missing`.
+    Returns [(user_id, posix body)]; `taken`, `used_uids` and `used_gids` are updated
+    in place. Loop-invariant lookups are bound to locals since this runs once per user.
+    """
+    planned: List[Tuple[str, Dict]] = []
+    append = planned.append
+    next_uid = IdAllocator(start_uid, used_uids).next
+    next_gid = IdAllocator(start_gid, used_gids).next
+    home_for = home_template.format
+    collision_counts: Dict[str, int] = {}
+
+    for user_id, full_name, base_username in missing:
+        uname = unique_username(base_username, taken, collision_counts)
+        uid = next_uid()
+        # used_gids is only consulted when GIDs are allocated independently
+        gid = uid if gid_equals_uid else next_gid()
+        append((user_id, {
+            "primary": True,
+            "username": uname,
+            "uid": uid,
+            "gid": gid,
+            "homeDirectory": home_for(username=uname),
+            "shell": default_shell,
+            "gecos": full_name,
+        }))
+    return planned
+
+
+# ---------- Patching ----------
+
+def patch_users_batched(
+    svc,
+    planned: List[Tuple[str, Dict]],
+    bucket: TokenBucket,
+    max_retries: int,
+    log: Log = None,
+) -> Tuple[int, Dict[str, Exception]]:
+    """
+    Write each planned posixAccounts body via users.patch, PATCH_BATCH_SIZE
+    sub-requests per batch HTTP call. Retryable sub-request failures are resent in a
+    follow-up batch after backoff. Returns (updated count, {user_id: last error})
+    for users that were not updated.
+    """
+    updated = 0
+    failed: Dict[str, Exception] = {}
+
+    for i in range(0, len(planned), PATCH_BATCH_SIZE):
+        chunk = dict(planned[i:i + PATCH_BATCH_SIZE])
+        pending = list(chunk)
+
+        for attempt in range(max_retries + 1):
+            # Pacing: one request per batch
+            bucket.acquire()
+
+            retry: List[str] = []
+            retry_exc: Optional[Exception] = None
+
+            def _cb(request_id, response, exception):
+                nonlocal updated, retry_exc
+                posix = chunk[request_id]
+                if exception is None:
+                    updated += 1
+                    failed.pop(request_id, None)
+                    if log:
+                        log(f"[OK] Updated {request_id} → {posix['username']} ({posix['uid']}:{posix['gid']})")
+                    return
+                failed[request_id] = exception
+                if is_retryable(exception):
+                    if log:
+                        status = exception.resp.status if getattr(exception, "resp", None) else None
+                        log(f"[WARN] patch backoff attempt {attempt+1} for {request_id}: {status}")
+                    retry.append(request_id)
+                    retry_exc = exception
+
+            batch = svc.new_batch_http_request(callback=_cb)
+            for user_id in pending:
+                batch.add(svc.users().patch(userKey=user_id, body={"posixAccounts": [chunk[user_id]]}),
+                          request_id=user_id)
+            try:
+                batch.execute()
+            except HttpError as e:
+                # The batch envelope itself failed; every sub-request is still pending
+                if not is_retryable(e):
+                    raise
+                if log:
+                    log(f"[WARN] batch backoff attempt {attempt+1}: {e.resp.status if e.resp else None}")
+                for user_id in pending:
+                    failed[user_id] = e
+                retry, retry_exc = pending, e
+
+            if not retry:
+                break
+            pending = retry
+            if attempt < max_retries:
+                sleep_for_retry(retry_exc, attempt)
+
+    return updated, failed
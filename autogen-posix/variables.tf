@@ -31,6 +31,12 @@ variable "start_uid" {
   default = 30000 
 }
 
+variable "max_uid" {
+  type        = number
+  description = "Highest UID to allocate (0 = unbounded). When set, used UIDs are tracked in a compact bitmap."
+  default     = 0
+}
+
 variable "start_gid" { 
   type = number
   default = 30000 
@@ -5,6 +5,7 @@ with a local SQLite cache to minimize rewrites and keep request counts low.
 
 Install:
   pip install google-auth google-auth-httplib2 google-api-python-client
+  pip install blake3   # optional, faster change detection
 
 Auth:
   - Service Account JSON with Domain-Wide Delegation (DWD)
@@ -22,59 +23,168 @@ Example:
 """
 
 import argparse
+import contextlib
 import datetime as dt
+import email.utils
 import grp
 import hashlib
+import itertools
 import json
+import math
+import operator
 import os
+import queue
 import random
+import re
 import sqlite3
+import string
 import sys
 import tempfile
+import threading
 import time
-from collections import defaultdict
-from typing import Dict, List, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Tuple, Optional
 
 from google.oauth2 import service_account
+from google_auth_httplib2 import AuthorizedHttp, Request
+import httplib2
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+try:
+    import blake3  # optional: faster snapshot hashing
+except ImportError:
+    blake3 = None
+
 SCOPES=["https://www.googleapis.com/auth/admin.directory.user.readonly",
         "https://www.googleapis.com/auth/admin.directory.group.readonly"]
 
 current_version = (sys.version_info.major, sys.version_info.minor)
-if sys.version_info.major >= 3:
-    if sys.version_info.minor >= 12:
-      NOW_ISO = dt.datetime.now(dt.UTC)
-    else:
-      NOW_ISO = dt.datetime.utcnow().isoformat(timespec="seconds")+"Z"
-else:
+if sys.version_info.major < 3:
     print("Python minimum major version : 3")
     sys.exit(1)
 
+# One timestamp per run; utcnow() is deprecated as of 3.12
+NOW_ISO = dt.datetime.now(dt.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+# Concurrent members.list calls during group sync (still bounded by --rps)
+MEMBER_FETCH_WORKERS = 8
+
+# Leading characters of the "email:<c>*" shards listed concurrently with --user-shards
+USER_SHARD_PREFIXES = string.ascii_lowercase + string.digits
+
 # -------------------- API + pacing --------------------
-def get_directory_service(sa_key_path: str, subject: str):
-    creds = service_account.Credentials.from_service_account_file(
+def get_credentials(sa_key_path: str, subject: str):
+    return service_account.Credentials.from_service_account_file(
         sa_key_path, scopes=SCOPES
     ).with_subject(subject)
-    return build("admin", "directory_v1", credentials=creds, cache_discovery=False)
 
 
-def pace(rps: float):
-    # light pacing to stay well below per-user 10 rps limit
-    if rps > 0:
-        time.sleep(1.0 / rps + random.random() * 0.05)
+def get_directory_service(sa_key_path: str, subject: str):
+    """Return (service, credentials); the worker pools reuse the same credentials."""
+    creds = get_credentials(sa_key_path, subject)
+    # Use the discovery document bundled with google-api-python-client (>= 2.0) so
+    # startup needs no discovery round trip; older clients fetch it over the network.
+    try:
+        svc = build("admin", "directory_v1", credentials=creds, cache_discovery=False, static_discovery=True)
+    except TypeError:
+        svc = build("admin", "directory_v1", credentials=creds, cache_discovery=False)
+    return svc, creds
+
+
+def refresh_credentials(creds):
+    # Fetch a token once up front so worker threads sharing creds don't race to refresh it
+    if not creds.valid:
+        creds.refresh(Request(httplib2.Http()))
+
+
+class TokenBucket:
+    """Thread-safe token bucket: callers share one request budget of `rate` per second."""
+
+    def __init__(self, rate: float, burst: float = 1.0):
+        self.rate = rate
+        self.capacity = max(1.0, burst)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= 1.0
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        # Sleep outside the lock; the token is already reserved
+        if wait > 0:
+            time.sleep(wait)
+
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+# error.errors[*].reason values, plus the google.rpc ErrorInfo reason for the same case
+RETRYABLE_REASONS = ("rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded", "RATE_LIMIT_EXCEEDED")
+
 
+def http_status(e: HttpError) -> Optional[int]:
+    resp = getattr(e, "resp", None)
+    return resp.status if resp is not None else None
 
-def backoff_sleep(attempt: int):
-    # attempt = 0,1,2,... exponential backoff with jitter (max ~32s)
-    delay = min(32, (2 ** attempt)) + random.random()
+
+def _has_retryable_reason(entries) -> bool:
+    return isinstance(entries, list) and any(
+        isinstance(d, dict) and d.get("reason") in RETRYABLE_REASONS for d in entries
+    )
+
+
+def is_retryable(e: HttpError) -> bool:
+    """Rate-limit / transient server errors, judged by status and the structured error reason."""
+    if http_status(e) in RETRYABLE_STATUSES:
+        return True
+    # Recent clients expose the parsed body as error_details, but that is the google.rpc
+    # "details" list when the body has one, and older clients do not set it at all; so
+    # fall back to the classic error.errors[*].reason list in the body itself.
+    if _has_retryable_reason(getattr(e, "error_details", None)):
+        return True
+    try:
+        errors = json.loads(e.content)["error"]["errors"]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return False
+    return _has_retryable_reason(errors)
+
+
+def retry_after_seconds(resp) -> Optional[float]:
+    """Parse a Retry-After header (delta-seconds or HTTP-date) from an httplib2 response."""
+    value = resp.get("retry-after") if resp is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=dt.timezone.utc)
+    return max(0.0, (when - dt.datetime.now(dt.timezone.utc)).total_seconds())
+
+
+def backoff_sleep(attempt: int, resp=None, base: float = 0.5, cap: float = 32.0):
+    # Honor the server's Retry-After hint when given (plus a little jitter); otherwise
+    # "full jitter": uniform over [0, min(cap, base * 2**attempt)], attempt = 0,1,2,...
+    delay = retry_after_seconds(resp)
+    if delay is not None:
+        delay += random.random() * 0.1
+    else:
+        delay = random.uniform(0, min(cap, base * (2 ** attempt)))
     time.sleep(delay)
 
 
 # -------------------- SQLite cache --------------------
 DDL = """
-PRAGMA journal_mode=WAL;
 CREATE TABLE IF NOT EXISTS users (
     id TEXT PRIMARY KEY,
     email TEXT,
@@ -86,7 +196,9 @@ CREATE TABLE IF NOT EXISTS users (
     shell TEXT,
     etag TEXT,
     active INTEGER NOT NULL DEFAULT 1,
-    updated_at TEXT
+    updated_at TEXT,
+    content_hash BLOB,                -- user_content_hash() of the columns above
+    lastchg INTEGER                   -- shadow(5) last-change day; set when the username first appears
 );
 CREATE TABLE IF NOT EXISTS meta (
     key TEXT PRIMARY KEY,
@@ -110,6 +222,19 @@ CREATE TABLE IF NOT EXISTS group_members (
     FOREIGN KEY (group_id) REFERENCES groups(group_id) ON DELETE CASCADE
 );
 
+-- Partial covering index for the active email -> username map used by group sync
+-- (active is included so the planner can answer the query from the index alone)
+CREATE INDEX IF NOT EXISTS idx_users_active_email ON users(email, username, active) WHERE active=1;
+
+-- Primary-group aggregation (GROUP BY gid over active users) without a sort
+CREATE INDEX IF NOT EXISTS idx_users_active_gid ON users(gid, username, active) WHERE active=1;
+
+-- passwd/shadow rendering (active users ORDER BY uid, username) as an index walk, no sort.
+-- No leading "active" column: without ANALYZE the planner would pick an index keyed on
+-- active=? for every WHERE active=1 query, bypassing the covering indexes above.
+DROP INDEX IF EXISTS idx_users_active_uid;
+CREATE INDEX IF NOT EXISTS idx_users_active_render ON users(uid, username) WHERE active=1;
+
 -- Optional: record allocator cursors
 CREATE TABLE IF NOT EXISTS allocators (
     key TEXT PRIMARY KEY,
@@ -119,17 +244,73 @@ CREATE TABLE IF NOT EXISTS allocators (
 """
 
 
+# Connection-scoped settings; must be applied on every new connection.
+# WAL + synchronous=NORMAL: one fsync per checkpoint instead of per commit.
+# mmap_size: read pages straight from the page cache instead of copying them in.
+# busy_timeout: wait on a concurrent writer instead of failing with SQLITE_BUSY.
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+)
+
+
+# Columns added after the first release; applied to caches created by older versions.
+MIGRATIONS = (
+    "ALTER TABLE users ADD COLUMN content_hash BLOB",
+    "ALTER TABLE users ADD COLUMN lastchg INTEGER",
+)
+
+
 def db_connect(db_path: str) -> sqlite3.Connection:
     os.makedirs(os.path.dirname(db_path), exist_ok=True)
     conn = sqlite3.connect(db_path)
-    conn.execute("PRAGMA foreign_keys=ON;")
-    for stmt in filter(None, DDL.split(";")):
-        s = stmt.strip()
-        if s:
-            conn.execute(s)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    conn.executescript(DDL)
+    for stmt in MIGRATIONS:
+        try:
+            conn.execute(stmt)
+        except sqlite3.OperationalError as e:
+            if "duplicate column" not in str(e):
+                raise
     return conn
 
 
+def begin_immediate(conn: sqlite3.Connection, attempts: int = 3):
+    """Open a write transaction, taking SQLite's RESERVED lock up front.
+
+    A deferred transaction only asks for the lock at its first write and can then fail
+    with "database is locked" mid-way; asking at BEGIN makes that the only place it can
+    happen. busy_timeout already waits on a concurrent writer; if that still expires,
+    retry a few times with a short backoff (50 ms, 100 ms, ...).
+    """
+    for attempt in range(attempts):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) or attempt == attempts - 1:
+                raise
+            time.sleep(0.05 * (2 ** attempt))
+
+
+@contextlib.contextmanager
+def write_transaction(conn: sqlite3.Connection):
+    """BEGIN IMMEDIATE ... COMMIT around the block; roll back if it raises."""
+    begin_immediate(conn)
+    try:
+        yield conn
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+
+
 def meta_get(conn: sqlite3.Connection, key: str) -> Optional[str]:
     cur = conn.execute("SELECT value FROM meta WHERE key=?", (key,))
     row = cur.fetchone()
@@ -143,83 +324,76 @@ def meta_set(conn: sqlite3.Connection, key: str, value: str):
     )
 
 
-def user_row_changed(db_row: Optional[tuple], new: dict) -> bool:
-    """Compare cached row with new values we care about; return True if different."""
-    if db_row is None:
-        return True
-    (
-        _id,
-        email,
-        username,
-        uid,
-        gid,
-        gecos,
-        home,
-        shell,
-        etag,
-        active,
-        _updated_at,
-    ) = db_row
-    return any(
-        [
-            username != new["username"],
-            email != new["email"],
-            uid != new["uid"],
-            gid != new["gid"],
-            gecos != new["gecos"],
-            home != new["home"],
-            shell != new["shell"],
-            etag != new.get("etag"),
-            active != 1,
-        ]
-    )
+def user_content_hash(record: dict) -> bytes:
+    """Digest of the cached fields of a user record, stored in users.content_hash."""
+    fields = (record["username"], record["email"], record["uid"], record["gid"],
+              record["gecos"], record["home"], record["shell"], record.get("etag"))
+    return hashlib.blake2b("\0".join(map(str, fields)).encode("utf-8"), digest_size=16).digest()
+
+
+# Change detection happens in SQLite: the DO UPDATE only fires when the stored
+# content_hash differs or the row was inactive, so unchanged users write nothing.
+# lastchg is kept while the username stays the same (rows cached before the column
+# existed pick it up on their next run).
+UPSERT_USER_SQL = """
+    INSERT INTO users(id, email, username, uid, gid, gecos, home, shell, etag, active, updated_at, content_hash, lastchg)
+    VALUES(:id, :email, :username, :uid, :gid, :gecos, :home, :shell, :etag, 1, :updated_at, :content_hash, :lastchg)
+    ON CONFLICT(id) DO UPDATE SET
+      lastchg=CASE WHEN users.username IS excluded.username
+                   THEN COALESCE(users.lastchg, excluded.lastchg) ELSE excluded.lastchg END,
+      username=excluded.username,
+      email=excluded.email,
+      uid=excluded.uid,
+      gid=excluded.gid,
+      gecos=excluded.gecos,
+      home=excluded.home,
+      shell=excluded.shell,
+      etag=excluded.etag,
+      active=1,
+      updated_at=excluded.updated_at,
+      content_hash=excluded.content_hash
+    WHERE users.content_hash IS NOT excluded.content_hash OR users.active <> 1 OR users.lastchg IS NULL
+"""
 
 
-def upsert_user(conn: sqlite3.Connection, record: dict):
-    conn.execute(
-        """
-        INSERT INTO users(id, email, username, uid, gid, gecos, home, shell, etag, active, updated_at)
-        VALUES(:id, :email, :username, :uid, :gid, :gecos, :home, :shell, :etag, 1, :updated_at)
-        ON CONFLICT(id) DO UPDATE SET
-          username=excluded.username,
-          email=excluded.email,
-          uid=excluded.uid,
-          gid=excluded.gid,
-          gecos=excluded.gecos,
-          home=excluded.home,
-          shell=excluded.shell,
-          etag=excluded.etag,
-          active=1,
-          updated_at=excluded.updated_at
-        """,
-        record,
-    )
+def upsert_users(conn: sqlite3.Connection, records: List[dict]):
+    conn.executemany(UPSERT_USER_SQL, records)
+
 
+def deactivate_missing_users(conn: sqlite3.Connection, present_ids: List[str],
+                             email_prefixes: Optional[str] = None) -> int:
+    """Deactivate active users not in present_ids.
 
-def deactivate_missing_users(conn: sqlite3.Connection, present_ids: List[str]) -> int:
-    qmarks = ",".join("?" for _ in present_ids) or "''"
-    cur = conn.execute(f"UPDATE users SET active=0 WHERE id NOT IN ({qmarks})", present_ids)
+    With email_prefixes, only rows whose email starts with one of those characters are
+    considered (the listing did not cover the others).
+    """
+    # Stage the ids in a temp table rather than binding one "?" per user, which hits
+    # SQLITE_MAX_VARIABLE_NUMBER on large domains and re-parses a huge statement.
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS present_users (id TEXT PRIMARY KEY)")
+    conn.execute("DELETE FROM present_users")
+    conn.executemany("INSERT OR IGNORE INTO present_users(id) VALUES(?)", ((i,) for i in present_ids))
+    sql = "UPDATE users SET active=0 WHERE active=1 AND id NOT IN (SELECT id FROM present_users)"
+    params: Tuple[str, ...] = ()
+    if email_prefixes is not None:
+        sql += " AND lower(substr(email, 1, 1)) IN (%s)" % ",".join("?" * len(email_prefixes))
+        params = tuple(email_prefixes)
+    cur = conn.execute(sql, params)
     return cur.rowcount
 
 
 # -------------------- Helpers --------------------
-def update_groups_db(svc, groups, conn, args):
+def update_groups_db(svc, creds, groups, conn, args):
 
     # Only user primary GIDs are external constraints; group GIDs are recomputed each run.
-    used_gids = set()
+    used_gids = GidBitmap(args.group_start_gid, args.group_end_gid)
     for (gid,) in conn.execute("SELECT gid FROM users WHERE active=1").fetchall():
         used_gids.add(int(gid))
 
-    # Temporarily set all group GIDs to unique negative placeholders so that
-    # the UNIQUE constraint on gid does not conflict during deterministic
-    # reassignment (GIDs may shift when groups are added or removed).
-    conn.execute("UPDATE groups SET gid = -ROWID")
-
-    active_group_ids = []
+    new_rows = []
     claimed_system_gids = set()
 
     # Sort groups by their stable Google group ID so that collision resolution
-    # (linear probing) is deterministic across independent service instances.
+    # (double-hash probing) is deterministic across independent service instances.
     for g in sorted(groups, key=lambda g: g["id"]):
         gname = sanitize_groupname(g.get("email",""))
 
@@ -233,58 +407,128 @@ def update_groups_db(svc, groups, conn, args):
         else:
             gid = deterministic_gid(g["id"], args.group_start_gid, args.group_end_gid, used_gids)
 
-        conn.execute("""
-          INSERT INTO groups(group_id,email,name,gid,etag,active,updated_at)
-          VALUES(?,?,?,?,?,1,?)
-          ON CONFLICT(group_id) DO UPDATE SET
-            email=excluded.email,
-            name=excluded.name,
-            gid=excluded.gid,
-            etag=excluded.etag,
-            active=1,
-            updated_at=excluded.updated_at
-        """, (g["id"], g.get("email",""), gname, gid, g.get("etag"), NOW_ISO))
+        new_rows.append((g["id"], g.get("email",""), gname, gid, g.get("etag")))
+
+    # Build a map email->username from user cache (active users)
+    # (index-only scan over idx_users_active_email)
+    email_to_username = {
+        email.lower(): uname
+        for email, uname in conn.execute("SELECT email, username FROM users WHERE active=1")
+        if email
+    }
 
-        active_group_ids.append(g["id"])
+    # Fetch all memberships before taking the write lock; no network I/O inside it
+    active_groups = [(group_id, email) for group_id, email, _name, _gid, _etag in new_rows]
+    want = set()
+    for (gid, _email), members in zip(active_groups, fetch_group_members(svc, creds, active_groups, args)):
+        want.update((gid, uname) for uname in member_usernames(members, email_to_username))
+
+    with write_transaction(conn):
+        apply_groups(conn, new_rows, want)
+
+
+def apply_groups(conn: sqlite3.Connection, new_rows, want):
+    """Store the group assignment and membership set (runs inside a write transaction)."""
+    # Apply the assignment set-wise from a temp table, in the same transaction as the
+    # membership refresh below.
+    conn.execute("""
+      CREATE TEMP TABLE IF NOT EXISTS new_groups (
+        group_id TEXT PRIMARY KEY, email TEXT, name TEXT, gid INTEGER, etag TEXT
+      )
+    """)
+    conn.execute("DELETE FROM new_groups")
+    conn.executemany("INSERT INTO new_groups(group_id,email,name,gid,etag) VALUES(?,?,?,?,?)", new_rows)
+
+    # GIDs may shift when groups are added or removed. Park only the groups whose GID
+    # changes (or that disappeared) on unique negative placeholders, so the UNIQUE
+    # constraint on gid cannot trip while the new GIDs are written.
+    conn.execute("""
+      UPDATE groups SET gid = -ROWID
+      WHERE gid IS NOT (SELECT n.gid FROM new_groups n WHERE n.group_id = groups.group_id)
+    """)
+    # Upsert in one statement; rows that are already up to date are not rewritten
+    conn.execute("""
+      INSERT INTO groups(group_id,email,name,gid,etag,active,updated_at)
+      SELECT group_id, email, name, gid, etag, 1, ? FROM new_groups WHERE true
+      ON CONFLICT(group_id) DO UPDATE SET
+        email=excluded.email,
+        name=excluded.name,
+        gid=excluded.gid,
+        etag=excluded.etag,
+        active=1,
+        updated_at=excluded.updated_at
+      WHERE groups.email IS NOT excluded.email OR groups.name IS NOT excluded.name
+         OR groups.gid IS NOT excluded.gid OR groups.etag IS NOT excluded.etag
+         OR groups.active <> 1
+    """, (NOW_ISO,))
 
     # Mark missing groups inactive
-    if active_group_ids:
-        qmarks = ",".join("?" for _ in active_group_ids)
-        conn.execute(f"UPDATE groups SET active=0 WHERE group_id NOT IN ({qmarks})", active_group_ids)
+    conn.execute("UPDATE groups SET active=0 WHERE active=1 AND group_id NOT IN (SELECT group_id FROM new_groups)")
+
+    # Refresh memberships: apply only the differences
+    cur = set(conn.execute(
+        "SELECT group_id, username FROM group_members WHERE group_id IN (SELECT group_id FROM new_groups)"
+    ))
+    conn.executemany("DELETE FROM group_members WHERE group_id=? AND username=?", cur - want)
+    conn.executemany("INSERT OR IGNORE INTO group_members(group_id, username) VALUES(?,?)", want - cur)
+
+def fetch_group_members(svc, creds, active_groups, args) -> List[List[dict]]:
+    """List the members of each (group_id, email) concurrently, in input order.
+
+    Requests are I/O bound, so a small worker pool overlaps their round trips while a
+    shared token bucket keeps the combined rate at --rps. The service object is shared,
+    but its httplib2 transport is not thread-safe, so each worker executes requests over
+    its own keep-alive AuthorizedHttp over the service's credentials. DB writes stay
+    on the caller's thread.
+    """
+    if not active_groups:
+        return []
+    bucket = TokenBucket(args.rps)
+    refresh_credentials(creds)
+    local = threading.local()
+
+    def members_of(email):
+        if getattr(local, "http", None) is None:
+            local.http = AuthorizedHttp(creds, http=httplib2.Http())
+        return list_group_members(svc, email, bucket, args.max_retries, http=local.http)
+
+    workers = min(MEMBER_FETCH_WORKERS, len(active_groups))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(members_of, [email for _gid, email in active_groups]))
+
+def member_usernames(members: List[dict], email_to_username: Dict[str, str]):
+    """Yield the cached usernames of the active USER members of a group."""
+    for m in members:
+        m_email = (m.get("email") or "").lower()
+        m_type  = (m.get("type")  or "").upper()
+        m_stat  = (m.get("status") or "").upper()
+
+        # Skip suspended/inactive membership entries
+        if m_stat and m_stat not in ("ACTIVE",):
+            continue
 
-    # Build a map email->username from user cache (active users)
-    email_to_username = {}
-    cols = conn.execute("PRAGMA table_info(users)").fetchall()
-    has_email = any(c[1] == "email" for c in cols)
-    if has_email:
-        for email, uname in conn.execute("SELECT email, username FROM users WHERE active=1").fetchall():
-            if email:
-                email_to_username[email.lower()] = uname
-
-    # Refresh memberships (simple approach: clear + repopulate per group)
-    for gid, email in conn.execute("SELECT group_id, email FROM groups WHERE active=1").fetchall():
-        conn.execute("DELETE FROM group_members WHERE group_id=?", (gid,))
-
-        members = list_group_members(svc, email, args.rps, args.max_retries)
-
-        for m in members:
-            m_email = (m.get("email") or "").lower()
-            m_type  = (m.get("type")  or "").upper()
-            m_stat  = (m.get("status") or "").upper()
-
-            # Skip suspended/inactive membership entries
-            if m_stat and m_stat not in ("ACTIVE",):
-                continue
-
-            if m_type == "USER":
-                uname = email_to_username.get(m_email)
-                if uname:
-                    conn.execute("INSERT OR IGNORE INTO group_members(group_id, username) VALUES(?,?)", (gid, uname))
-            else:
-                # Currently, we don't support groups of groups.
-                pass
+        if m_type == "USER":
+            uname = email_to_username.get(m_email)
+            if uname:
+                yield uname
+        else:
+            # Currently, we don't support groups of groups.
+            pass
 
-    conn.commit()
+def prefetch_pages(collection, req, fetch):
+    """Yield each list response while the next page is already being fetched.
+
+    `fetch(req)` executes one request (pacing + retries). A single background worker
+    means only one request is in flight at a time, so the service is never shared
+    between threads concurrently.
+    """
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        fut = pool.submit(fetch, req)
+        while fut is not None:
+            resp = fut.result()
+            req = collection.list_next(previous_request=req, previous_response=resp)
+            fut = pool.submit(fetch, req) if req is not None else None
+            yield resp
 
 def list_all_groups(svc, customer, domain, rps, max_retries):
     kwargs = {
@@ -296,23 +540,24 @@ def list_all_groups(svc, customer, domain, rps, max_retries):
     else:
         kwargs["customer"] = customer or "my_customer"
 
-    groups = []
-    req = svc.groups().list(**kwargs)
-    while req is not None:
-        pace(rps)
+    bucket = TokenBucket(rps)
+
+    def fetch(req):
+        bucket.acquire()
         for attempt in range(max_retries + 1):
             try:
-                resp = req.execute(); break
+                return req.execute()
             except HttpError as e:
-                s = getattr(e, "resp", None).status if getattr(e, "resp", None) else None
-                if s in (429,500,502,503,504) or "rateLimitExceeded" in str(e) or "userRateLimitExceeded" in str(e):
-                    backoff_sleep(attempt); continue
+                if is_retryable(e) and attempt < max_retries:
+                    backoff_sleep(attempt, e.resp); continue
                 raise
+
+    groups = []
+    for resp in prefetch_pages(svc.groups(), svc.groups().list(**kwargs), fetch):
         groups.extend(resp.get("groups", []))
-        req = svc.groups().list_next(previous_request=req, previous_response=resp)
     return groups
 
-def list_group_members(svc, group_email: str, rps: float, max_retries: int) -> list[dict]:
+def list_group_members(svc, group_email: str, bucket: TokenBucket, max_retries: int, http=None) -> list[dict]:
     kwargs = {
         "groupKey": group_email,
         "maxResults": 200,
@@ -321,27 +566,39 @@ def list_group_members(svc, group_email: str, rps: float, max_retries: int) -> l
     members = []
     req = svc.members().list(**kwargs)
     while req is not None:
-        pace(rps)
+        bucket.acquire()
         for attempt in range(max_retries + 1):
             try:
-                resp = req.execute(); break
+                resp = req.execute(http=http); break
             except HttpError as e:
-                s = getattr(e, "resp", None).status if getattr(e, "resp", None) else None
-                if s in (429,500,502,503,504) or "rateLimitExceeded" in str(e) or "userRateLimitExceeded" in str(e):
-                    backoff_sleep(attempt); continue
+                if is_retryable(e) and attempt < max_retries:
+                    backoff_sleep(attempt, e.resp); continue
                 # common: 404 if group vanished between list and member fetch
-                if s == 404:
+                if http_status(e) == 404:
                     return []
                 raise
         members.extend(resp.get("members", []) or [])
         req = svc.members().list_next(previous_request=req, previous_response=resp)
     return members
 
+_NAME_CHARS = frozenset(string.ascii_lowercase + string.digits + "-_.")
+# str.translate table deleting every ASCII character not allowed in a user/group name
+_NAME_DROP_ASCII = str.maketrans("", "", "".join(chr(i) for i in range(128) if chr(i) not in _NAME_CHARS))
+_DOMAIN_SUFFIX_RE = re.compile(r'_[a-z0-9]+_com$')
+
+
+def _filter_name_chars(s: str) -> str:
+    """Lowercase and keep [a-z0-9._-] (plus non-ASCII letters/digits, as isalnum() allows)."""
+    lowered = s.lower()
+    if lowered.isascii():
+        return lowered.translate(_NAME_DROP_ASCII)
+    return "".join(c for c in lowered if c.isalnum() or c in ("-", "_", "."))
+
+
 def sanitize_groupname(email: str) -> str:
     # default: email local-part
     local = email.split("@")[0] if "@" in email else email
-    name = "".join(c for c in local.lower() if c.isalnum() or c in ("-", "_", "."))
-    return name
+    return _filter_name_chars(local)
 
 
 def get_system_gid(groupname: str, managed_start: int, managed_end: int) -> Optional[int]:
@@ -357,86 +614,162 @@ def get_system_gid(groupname: str, managed_start: int, managed_end: int) -> Opti
         return None
 
 
-def deterministic_gid(group_id: str, start: int, end: int, used: set[int]) -> int:
+class GidBitmap:
+    """Set of claimed GIDs in [start, end] stored one bit per GID; others are ignored."""
+
+    def __init__(self, start: int, end: int):
+        self.start = start
+        self.size = end - start + 1
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def add(self, gid: int):
+        i = gid - self.start
+        if 0 <= i < self.size:
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, gid: int) -> bool:
+        i = gid - self.start
+        return 0 <= i < self.size and bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+
+def deterministic_gid(group_id: str, start: int, end: int, used: GidBitmap) -> int:
     """Compute a deterministic GID from a Google Group ID via SHA-256 hashing.
 
     Maps the hash of the group_id into [start, end].  On collision with an
     already-claimed GID (user primary GID or earlier group in sorted order),
-    probes linearly (wrapping) until a free slot is found.
+    probes by double hashing: the step is derived from a second, independent
+    slice of the digest and is coprime with the range size, so every slot is
+    visited and colliding groups do not pile up into runs the way linear
+    probing does as the range fills.
 
     Because groups are processed in sorted order by group_id and the hash is
     deterministic, independent instances processing the same set of groups
     will always arrive at the same GID assignments.
     """
     range_size = end - start + 1
-    h = int.from_bytes(
-        hashlib.sha256(group_id.encode("utf-8")).digest()[:8], "big"
-    )
-    base = start + (h % range_size)
+    digest = hashlib.sha256(group_id.encode("utf-8")).digest()
+    h1 = int.from_bytes(digest[:8], "big")
+    h2 = int.from_bytes(digest[8:16], "big")
+
+    step = 1 + h2 % (range_size - 1) if range_size > 1 else 1
+    while math.gcd(step, range_size) != 1:
+        step += 1
 
-    for offset in range(range_size):
-        candidate = start + (base - start + offset) % range_size
+    slot = h1 % range_size
+    for _ in range(range_size):
+        candidate = start + slot
         if candidate not in used:
             used.add(candidate)
             return candidate
+        slot = (slot + step) % range_size
 
     raise RuntimeError(f"Out of group GIDs in range [{start},{end}]")
 
-def fetch_users(svc, args):
+def fetch_users(svc, creds, args) -> Iterator[dict]:
 
     # Build request
     base_req = {
         "projection": "full",
         "maxResults": 200,  # Admin SDK max
         "orderBy": "email",
+        # Only what update_users_db() reads; the full projection is many times larger
+        "fields": "nextPageToken,users(id,etag,primaryEmail,suspended,deleted,name/fullName,"
+                  "posixAccounts(primary,username,uid,gid,gecos,homeDirectory,shell))",
     }
     if args.domain:
         base_req["domain"] = args.domain
     else:
         base_req["customer"] = args.customer
 
-    # Fetch users with pagination, pacing, and retries
-    users: List[dict] = []
-    req = svc.users().list(**base_req)
-    while req is not None:
-        # pacing
-        pace(args.rps)
+    # Fetch users with pagination, pacing, and retries; one bucket covers every shard
+    bucket = TokenBucket(args.rps)
+
+    def fetch(req, http=None):
+        bucket.acquire()
         for attempt in range(args.max_retries + 1):
             try:
-                resp = req.execute()
-                break
+                return req.execute(http=http)
             except HttpError as e:
-                code = getattr(e, "status_code", None)
                 # Handle rate & 5xx-ish
-                if e.resp and e.resp.status in (429, 500, 502, 503, 504) or (
-                    "rateLimitExceeded" in str(e) or "userRateLimitExceeded" in str(e)
-                ):
-                    if attempt < args.max_retries:
-                        if args.verbose:
-                            print(f"Rate/Server error ({e.resp.status if e.resp else '??'}). Backing off (attempt {attempt+1})", file=sys.stderr)
-                        backoff_sleep(attempt)
-                        continue
+                if is_retryable(e) and attempt < args.max_retries:
+                    if args.verbose:
+                        print(f"Rate/Server error ({http_status(e) or '??'}). Backing off (attempt {attempt+1})", file=sys.stderr)
+                    backoff_sleep(attempt, e.resp)
+                    continue
                 # other errors: fail
                 raise
-        users.extend(resp.get("users", []))
-        req = svc.users().list_next(previous_request=req, previous_response=resp)
+
+    # Yield users page by page so the caller processes them as they arrive and only
+    # about one page of raw API objects is alive at a time
+    if args.user_shards > 1:
+        pages = fetch_user_shards(svc, creds, base_req, fetch, args)
+    else:
+        pages = (resp.get("users", []) for resp in prefetch_pages(svc.users(), svc.users().list(**base_req), fetch))
+    fetched = 0
+    for page in pages:
+        fetched += len(page)
+        yield from page
 
     if args.verbose:
-        print(f"Fetched {len(users)} users", file=sys.stderr)
+        print(f"Fetched {fetched} users", file=sys.stderr)
 
-    return users
+def fetch_user_shards(svc, creds, base_req, fetch, args) -> Iterator[List[dict]]:
+    """Yield pages of users from the USER_SHARD_PREFIXES shards, listed concurrently.
 
-def update_users_db(users, conn, args):
+    Each worker pages through whole shards over its own AuthorizedHttp; `fetch` paces
+    every request through the shared bucket. Pages are yielded as soon as any shard
+    fetches one. An "email:<c>*" query also matches aliases, so one user can come back
+    from several shards; only the first copy of each id is yielded. If a shard fails,
+    the others stop at their next page and the error is re-raised.
+    """
+    refresh_credentials(creds)
+    local = threading.local()
+    users = svc.users()
+    done = object()
+    pages = queue.Queue()
+    stop = threading.Event()
+
+    def shard(prefix):
+        try:
+            if getattr(local, "http", None) is None:
+                local.http = AuthorizedHttp(creds, http=httplib2.Http())
+            req = users.list(query=f"email:{prefix}*", **base_req)
+            while req is not None and not stop.is_set():
+                resp = fetch(req, local.http)
+                pages.put(resp.get("users", []))
+                req = users.list_next(previous_request=req, previous_response=resp)
+            pages.put(done)
+        except BaseException as e:
+            pages.put(e)
+
+    seen = set()
+    workers = min(args.user_shards, len(USER_SHARD_PREFIXES))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(shard, c) for c in USER_SHARD_PREFIXES]
+        remaining = len(futures)
+        while remaining:
+            item = pages.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, BaseException):
+                stop.set()
+                for fut in futures:
+                    fut.cancel()
+                raise item
+            else:
+                page = [u for u in item if u["id"] not in seen]
+                seen.update(u["id"] for u in page)
+                yield page
+
+def update_users_db(users, conn, args, lastchg: int):
 
     # First, mark all as inactive; we'll reactivate those we see (more efficient with NOT IN at end)
     present_ids: List[str] = []
 
-    # Prepare UNIX data + detect shared primary GIDs
-    gid_to_usernames: Dict[int, List[str]] = defaultdict(list)
+    # Prepare UNIX data
     active_entries: List[dict] = []
 
-    # Build current snapshot & update DB
-
+    # Build current snapshot
     for u in users:
         if u.get("deleted") or u.get("suspended"):
             continue
@@ -465,32 +798,32 @@ def update_users_db(users, conn, args):
             "shell": shell,
             "etag": u.get("etag"),
             "updated_at": NOW_ISO,
+            "lastchg": lastchg,  # only stored for new usernames, see UPSERT_USER_SQL
         }
-
-        # Compare with DB, upsert if changed
-        cur = conn.execute("SELECT * FROM users WHERE id=?", (u["id"],))
-        row = cur.fetchone()
-        if user_row_changed(row, record):
-            upsert_user(conn, record)
-        else:
-            # even if unchanged, ensure active=1
-            conn.execute("UPDATE users SET active=1 WHERE id=?", (u["id"],))
+        record["content_hash"] = user_content_hash(record)
 
         present_ids.append(u["id"])
-        gid_to_usernames[int(gid)].append(username)
         active_entries.append(record)
 
-    # Deactivate users not present in current fetch
-    deactivated = deactivate_missing_users(conn, present_ids) if present_ids else 0
-    conn.commit()
-    return active_entries, gid_to_usernames, deactivated
+    # Update DB in one transaction; UPSERT_USER_SQL skips rows that did not change
+    with write_transaction(conn):
+        upsert_users(conn, active_entries)
+
+        # Deactivate users not present in current fetch. Sharded listings return every
+        # user whose primary email starts with USER_SHARD_PREFIXES, and nothing is known
+        # about the rest, so only the covered rows are deactivated then.
+        if present_ids:
+            prefixes = USER_SHARD_PREFIXES if args.user_shards > 1 else None
+            deactivated = deactivate_missing_users(conn, present_ids, prefixes)
+        else:
+            deactivated = 0
+    return deactivated
 
 def sanitize_username(u: str) -> str:
-    import re
     # lowercase and replace disallowed chars
-    name = "".join(c for c in u.lower() if c.isalnum() or c in ("-", "_", "."))
+    name = _filter_name_chars(u)
     # strip "_example_com" or similar suffixes that Google appends
-    name = re.sub(r'_[a-z0-9]+_com$', '', name)
+    name = _DOMAIN_SUFFIX_RE.sub('', name)
     # truncate to 32 chars (Linux username max by default)
     return name[:32] or "user"
 
@@ -502,23 +835,137 @@ def pick_posix_account(posix_accounts: List[dict]) -> Optional[dict]:
     return prim[0] if prim else posix_accounts[0]
 
 
-def atomic_write(path: str, content: str, mode: int = 0o640):
+def _write_named_temp(dname: str, chunks: Iterable[bytes], mode: int) -> str:
+    with tempfile.NamedTemporaryFile("wb", dir=dname, delete=False, buffering=1 << 20) as tmp:
+        try:
+            tmp.writelines(chunks)
+            tmp.flush()
+            os.fchmod(tmp.fileno(), mode)
+            os.fsync(tmp.fileno())
+        except BaseException:
+            os.unlink(tmp.name)
+            raise
+        return tmp.name
+
+
+def _link_anonymous(fd: int, dname: str, path: str) -> str:
+    """Give an O_TMPFILE inode a unique temp name beside `path`; return that name."""
+    for _ in range(100):
+        name = os.path.join(dname, f".{os.path.basename(path)}.{random.getrandbits(32):08x}.tmp")
+        try:
+            os.link(f"/proc/self/fd/{fd}", name)
+            return name
+        except FileExistsError:
+            continue
+    raise FileExistsError(f"no free temp name for {path}")
+
+
+def write_temp(path: str, chunks: Iterable[bytes], mode: int = 0o640) -> str:
+    """Stream encoded chunks into a durable (fsynced) temp file beside `path`; return its name.
+
+    On Linux the data goes into an anonymous O_TMPFILE inode that only gets a name once
+    it is complete and fsynced, so a crash mid-write leaves no stray temp file. Where
+    that is unsupported (filesystem, kernel, no /proc), a named temp file is used.
+    """
     dname = os.path.dirname(path)
     os.makedirs(dname, exist_ok=True)
-    with tempfile.NamedTemporaryFile("w", dir=dname, delete=False) as tmp:
-        tmp.write(content)
-        tmp_name = tmp.name
-    os.chmod(tmp_name, mode)
-    os.replace(tmp_name, path)
+    try:
+        fd = os.open(dname, os.O_TMPFILE | os.O_RDWR, mode)
+    except (AttributeError, OSError):
+        return _write_named_temp(dname, chunks, mode)
+
+    with os.fdopen(fd, "w+b", buffering=1 << 20) as f:
+        f.writelines(chunks)
+        f.flush()
+        os.fchmod(f.fileno(), mode)
+        os.fsync(f.fileno())
+        try:
+            return _link_anonymous(f.fileno(), dname, path)
+        except OSError:
+            # Linking refused (e.g. /proc unavailable); copy the data out instead
+            f.seek(0)
+            return _write_named_temp(dname, iter(lambda: f.read(1 << 20), b""), mode)
+
+
+def atomic_write_files(files: List[Tuple[str, Iterable[bytes], int]]):
+    """Write (path, chunks, mode) files: temps in parallel, then renames in order.
+
+    The writes and fsyncs of independent files overlap on a small thread pool; the
+    renames run afterwards on this thread, once every temp file is complete, so a
+    failure while writing leaves all existing files untouched.
+    """
+    with ThreadPoolExecutor(max_workers=len(files)) as pool:
+        futs = [pool.submit(write_temp, path, chunks, mode) for path, chunks, mode in files]
+    try:
+        tmp_names = [f.result() for f in futs]
+    except BaseException:
+        for f in futs:
+            if not f.exception():
+                os.unlink(f.result())
+        raise
+    for (path, _chunks, _mode), tmp_name in zip(files, tmp_names):
+        os.replace(tmp_name, path)
+    # Persist the renames themselves
+    for dname in {os.path.dirname(path) for path, _chunks, _mode in files}:
+        dfd = os.open(dname, os.O_RDONLY)
+        try:
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
+
+
+# Line formatters: str/bytes.__mod__ bound to each template, applied with map() in C.
+# passwd/shadow rows are read from SQLite as bytes (see main), so their templates are
+# bytes and skip both the decode and the re-encode.
+_PASSWD_LINE = b"%s:x:%d:%d:%s:%s:%s\n".__mod__
+_SHADOW_LINE = b"%s:!:%d:0:99999:7:::\n".__mod__
+_GROUP_LINE = "%s:x:%d:%s\n".__mod__
+RENDER_BATCH = 1024
+
+
+def _render(fmt, rows) -> Iterator[bytes]:
+    """Yield fmt() over rows, joined and encoded RENDER_BATCH lines at a time."""
+    for i in range(0, len(rows), RENDER_BATCH):
+        yield "".join(map(fmt, rows[i:i + RENDER_BATCH])).encode("utf-8")
+
+
+def _render_bytes(fmt, rows) -> Iterator[bytes]:
+    """Like _render() for bytes templates over bytes fields; nothing to encode."""
+    for i in range(0, len(rows), RENDER_BATCH):
+        yield b"".join(map(fmt, rows[i:i + RENDER_BATCH]))
+
+
+def render_passwd(rows) -> Iterator[bytes]:
+    # rows: (username, uid, gid, gecos, home, shell), text fields as UTF-8 bytes
+    return _render_bytes(_PASSWD_LINE, rows)
+
+
+def render_shadow(shadow_rows) -> Iterator[bytes]:
+    # shadow_rows: (username, lastchg), username as UTF-8 bytes
+    return _render_bytes(_SHADOW_LINE, shadow_rows)
+
+
+def render_group(group_rows) -> Iterator[bytes]:
+    # group_rows: (name, gid, members_csv)
+    return _render(_GROUP_LINE, group_rows)
 
 
 def days_since_epoch() -> int:
-    epoch = dt.date(1970, 1, 1)
-    return (dt.date.today() - epoch).days
+    # UTC days, as shadow(5) and shadow-utils count them
+    return int(time.time()) // 86400
+
 
+def snapshot_hash(rows) -> str:
+    """Change detector over the rows one file is rendered from (not a security boundary).
 
-def sha256(s: str) -> str:
-    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+    Hashing the raw rows lets an unchanged file skip rendering altogether. Each block's
+    repr() is built in C and is unambiguous across field boundaries. Uses BLAKE3 when
+    the blake3 package is installed, else BLAKE2b.
+    """
+    h = blake3.blake3() if blake3 else hashlib.blake2b(digest_size=16)
+    for i in range(0, len(rows), RENDER_BATCH):
+        h.update(repr(rows[i:i + RENDER_BATCH]).encode("utf-8"))
+    return h.hexdigest()
 
 
 # -------------------- Main sync --------------------
@@ -536,6 +983,10 @@ def main():
     ap.add_argument("--group-start-gid", type=int, default=30000, help="Starting gid for Google Groups -> POSIX Groups")
     ap.add_argument("--group-end-gid", type=int, default=39999, help="Ending gid for Google Groups -> POSIX Groups")
     ap.add_argument("--rps", type=float, default=5.0, help="Max requests per second (API pacing).")
+    ap.add_argument("--user-shards", type=int, default=0,
+                    help="List users over N concurrent email-prefix shards (a-z, 0-9). Cached users "
+                         "whose email starts with any other character are neither refreshed nor "
+                         "deactivated (even if suspended or deleted); run without it to cover them.")
     ap.add_argument("--max-retries", type=int, default=5, help="Max retries on rate/5xx errors.")
     ap.add_argument("--dry-run", action="store_true", help="Print would-be files; do not write.")
     ap.add_argument("--verbose", action="store_true", help="Verbose logs to stderr.")
@@ -543,7 +994,7 @@ def main():
 
     # Build service
     try:
-        svc = get_directory_service(args.sa_key, args.impersonate)
+        svc, creds = get_directory_service(args.sa_key, args.impersonate)
     except Exception as e:
         print(f"ERROR: failed to create Directory service: {e}", file=sys.stderr)
         sys.exit(1)
@@ -551,87 +1002,106 @@ def main():
     # DB connect
     conn = db_connect(args.db)
 
-    users = fetch_users(svc, args)
+    users = fetch_users(svc, creds, args)
 
-    active_entries, gid_to_usernames, deactivated = update_users_db(users, conn, args)
+    lastchg = days_since_epoch()
+    deactivated = update_users_db(users, conn, args, lastchg)
 
     if args.group_sync:
         if args.verbose:
             print("Getting groups")
         groups = list_all_groups(svc, args.customer if not args.domain else None, args.domain, args.rps, args.max_retries)
-        update_groups_db(svc, groups, conn, args)
+        update_groups_db(svc, creds, groups, conn, args)
 
 
     ####### Render extrausers files ########
-    # Compose groups dict (gid->name, members empty; primary implied)
-    groups: Dict[int, Tuple[str, set]] = {}
-    for gid, members in gid_to_usernames.items():
-        grpname = members[0] if len(members) == 1 else f"grp{gid}"
-        groups[gid] = (grpname, set())
-
-    # Build passwd, shadow, group for *active* users from DB to be authoritative
-    cur = conn.execute(
-        "SELECT username, uid, gid, gecos, home, shell FROM users WHERE active=1 ORDER BY uid, username"
-    )
-    rows = cur.fetchall()
-
-    passwd_lines: List[str] = []
-    shadow_lines: List[str] = []
-    for username, uid, gid, gecos, home, shell in rows:
-        passwd_lines.append(f"{username}:x:{uid}:{gid}:{gecos}:{home}:{shell}")
-        lastchg = days_since_epoch()
-        shadow_lines.append(f"{username}:!:{lastchg}:0:99999:7:::")
-
-    group_lines: List[str] = []
-    for gid in sorted(groups.keys()):
-        name, members = groups[gid]
-        members_csv = ",".join(sorted(members)) if members else ""
-        group_lines.append(f"{name}:x:{gid}:{members_csv}")
+    # Primary groups (members empty; membership is implied by the passwd gid).
+    # A primary GID owned by one user is named after them; shared GIDs get "grp<gid>"
+    group_rows: List[Tuple[str, int, str]] = [
+        (any_user if cnt == 1 else f"grp{gid}", gid, "")
+        for gid, any_user, cnt in conn.execute(
+            "SELECT gid, MIN(username), COUNT(*) FROM users WHERE active=1 GROUP BY gid ORDER BY gid"
+        )
+    ]
+    n_primary_groups = len(group_rows)
+
+    # Build passwd, shadow for *active* users from DB to be authoritative: one row per
+    # user id whatever the fetch returned, including cached users that an empty fetch or
+    # a sharded listing left active. One scan feeds both files; lastchg is per user and
+    # sticky, so shadow only changes when its usernames do (rows cached before the
+    # column existed and not upserted this run show today's date).
+    # Text columns come back as the stored UTF-8 bytes and go to the files unchanged,
+    # instead of being decoded here and encoded again by the renderer.
+    conn.text_factory = bytes
+    try:
+        user_rows = conn.execute(
+            "SELECT username, uid, gid, gecos, home, shell, COALESCE(lastchg, ?) FROM users "
+            "WHERE active=1 ORDER BY uid, username",
+            (lastchg,),
+        ).fetchall()
+    finally:
+        conn.text_factory = str
+    rows = list(map(operator.itemgetter(0, 1, 2, 3, 4, 5), user_rows))
+    shadow_rows = list(map(operator.itemgetter(0, 6), user_rows))
 
     # Add google groups
-    grows = conn.execute("SELECT group_id, name, gid FROM groups WHERE active=1 ORDER BY gid, name").fetchall()
-    for group_id, gname, gid in grows:
-        members = [u for (u,) in conn.execute(
-            "SELECT username FROM group_members WHERE group_id=? ORDER BY username", (group_id,)
-        ).fetchall()]
-        group_lines.append(f"{gname}:x:{gid}:{','.join(members)}")
-
-    passwd_txt = "\n".join(passwd_lines) + ("\n" if passwd_lines else "")
-    group_txt = "\n".join(group_lines) + ("\n" if group_lines else "")
-    shadow_txt = "\n".join(shadow_lines) + ("\n" if shadow_lines else "")
-
-    # Change detection via snapshot hash (fast path)
-    snapshot_hash = sha256(passwd_txt + "\n--\n" + group_txt + "\n--\n" + shadow_txt)
-    prev_hash = meta_get(conn, "last_snapshot_hash")
-    changed = snapshot_hash != prev_hash
+    # One ordered join for all groups + members, merged per group in Python.
+    # (The group_members primary key (group_id, username) serves the join in order.)
+    grows = conn.execute(
+        """
+        SELECT g.group_id, g.name, g.gid, m.username
+        FROM groups g LEFT JOIN group_members m ON m.group_id = g.group_id
+        WHERE g.active=1
+        ORDER BY g.gid, g.name, m.username
+        """
+    )
+    google_group_rows = [
+        (gname, gid, ",".join([m[3] for m in members if m[3] is not None]))
+        for (_group_id, gname, gid), members in itertools.groupby(grows, key=lambda r: r[:3])
+    ]
+    n_google_groups = len(google_group_rows)
+    group_rows.extend(google_group_rows)
+
+    # Typical perms for extrausers:
+    #   passwd: 0644, group: 0644, shadow: 0640
+    outputs = [
+        ("passwd", rows, render_passwd, 0o644),
+        ("group", group_rows, render_group, 0o644),
+        ("shadow", shadow_rows, render_shadow, 0o640),
+    ]
+
+    # Change detection per file via a hash of its raw rows (fast path); a file is only
+    # rendered and rewritten when its own rows changed (or for --dry-run)
+    changed = []
+    for name, file_rows, _render_fn, _mode in outputs:
+        digest = snapshot_hash(file_rows)
+        if digest != meta_get(conn, f"hash_{name}"):
+            changed.append((name, digest))
 
     if args.verbose:
         print(
-            f"Active users: {len(rows)} | groups: {len(groups)}+{len(grows)} | changed: {changed} "
+            f"Active users: {len(rows)} | groups: {n_primary_groups}+{n_google_groups} "
+            f"| changed: {','.join(name for name, _digest in changed) or 'none'} "
             f"| deactivated this run: {deactivated}",
             file=sys.stderr,
         )
 
-    out_passwd = os.path.join(args.outdir, "passwd")
-    out_group = os.path.join(args.outdir, "group")
-    out_shadow = os.path.join(args.outdir, "shadow")
-
     if args.dry_run:
-        print("# ---- PASSWD ----")
-        print(passwd_txt, end="")
-        print("# ---- GROUP ----")
-        print(group_txt, end="")
-        print("# ---- SHADOW ----")
-        print(shadow_txt, end="")
+        for name, file_rows, render_fn, _mode in outputs:
+            print(f"# ---- {name.upper()} ----", flush=True)
+            sys.stdout.buffer.writelines(render_fn(file_rows))
+            sys.stdout.buffer.flush()
     else:
         if changed:
-            # Typical perms for extrausers:
-            #   passwd: 0644, group: 0644, shadow: 0640
-            atomic_write(out_passwd, passwd_txt, 0o644)
-            atomic_write(out_group, group_txt, 0o644)
-            atomic_write(out_shadow, shadow_txt, 0o640)
-            meta_set(conn, "last_snapshot_hash", snapshot_hash)
-            conn.commit()
+            changed_names = {name for name, _digest in changed}
+            atomic_write_files([
+                (os.path.join(args.outdir, name), render_fn(file_rows), mode)
+                for name, file_rows, render_fn, mode in outputs
+                if name in changed_names
+            ])
+            with write_transaction(conn):
+                for name, digest in changed:
+                    meta_set(conn, f"hash_{name}", digest)
             if args.verbose:
                 print("Wrote updated extrausers files.", file=sys.stderr)
         else: